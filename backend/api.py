@@ -8,7 +8,12 @@ from typing import Dict, List, Optional
 from datetime import datetime
 import shutil
 import logging
-from groq import Groq
+from contextlib import asynccontextmanager
+import portalocker
+import asyncio
+import copy
+import math
+from groq import AsyncGroq, APIConnectionError, InternalServerError, RateLimitError
 import chromadb
 import torch
 import requests
@@ -16,19 +21,46 @@ from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer
 from chromadb.config import Settings
 from chromadb.utils import embedding_functions
 from huggingface_hub import login
+from groq_scheduler import GroqScheduler, ModelLimits, Priority, SchedulerConfig, SchedulerOverloadedError
 import os
-os.environ['HF_TOKEN'] = ""  # Remplacez par votre vrai token
-login(token=os.environ['HF_TOKEN'])
+os.environ.setdefault('HF_TOKEN', "")  # Remplacez par votre vrai token (ou variable d'environnement)
+if os.environ['HF_TOKEN']:
+    login(token=os.environ['HF_TOKEN'])
 n_context_results: int = 1  # Ajout du paramètre manquant
 # Configuration du logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_reader()
+    yield
+    stop_reader()
+
+app = FastAPI(lifespan=lifespan)
+
+# Mode de déploiement
+class ServingRole(str, Enum):
+    STANDALONE = "standalone"  # Un seul processus qui indexe et répond
+    WRITER = "writer"          # Processus unique d'indexation (thèmes, uploads)
+    READER = "reader"          # Workers de requêtes en lecture seule
+
+RAG_ROLE = ServingRole(os.getenv("RAG_ROLE", ServingRole.STANDALONE.value))
+CHROMA_HOST = os.getenv("CHROMA_HOST")  # Serveur Chroma partagé (obligatoire pour les readers)
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8001"))
+RAG_WRITER_URL = os.getenv("RAG_WRITER_URL")  # Source des thèmes pour les readers multi-nœuds
+RAG_QUERY_WORKERS = int(os.getenv("RAG_QUERY_WORKERS", "1"))  # Nombre total de workers partageant la clé Groq
+THEMES_REFRESH_SECONDS = float(os.getenv("THEMES_REFRESH_SECONDS", "2"))
+THEMES_MAX_BACKOFF_SECONDS = float(os.getenv("THEMES_MAX_BACKOFF_SECONDS", "30"))
+
+if RAG_ROLE == ServingRole.READER and not CHROMA_HOST:
+    raise RuntimeError("RAG_ROLE=reader nécessite CHROMA_HOST : les readers n'ouvrent pas la base locale")
+if RAG_ROLE == ServingRole.WRITER and not CHROMA_HOST:
+    raise RuntimeError("RAG_ROLE=writer nécessite CHROMA_HOST : les readers ne verraient pas une base locale")
 
 # Configuration des chemins
 BASE_DIR = Path(__file__).parent
-STORAGE_DIR = BASE_DIR / "storage"
+STORAGE_DIR = Path(os.getenv("RAG_STORAGE_DIR", BASE_DIR / "storage"))
 THEMES_FILE = STORAGE_DIR / "themes.json"
 DATA_DIR = STORAGE_DIR / "data"
 CHROMA_DIR = STORAGE_DIR / "chroma_db"
@@ -36,8 +68,25 @@ CHROMA_DIR = STORAGE_DIR / "chroma_db"
 # Création des dossiers
 for dir_path in [STORAGE_DIR, DATA_DIR, CHROMA_DIR]:
     dir_path.mkdir(exist_ok=True)
-# Configuration ChromaDB
-chroma_client = chromadb.PersistentClient(path=str(CHROMA_DIR), settings=Settings(allow_reset=True))
+
+# Un seul processus écrit dans STORAGE_DIR : un second writer (autre réplique ou
+# `uvicorn --workers N`) refuse de démarrer. Le verrou est libéré à la fin du processus.
+writer_lock_file = None
+if RAG_ROLE != ServingRole.READER:
+    writer_lock_file = open(STORAGE_DIR / "writer.lock", "a")
+    try:
+        portalocker.lock(writer_lock_file, portalocker.LOCK_EX | portalocker.LOCK_NB)
+    except portalocker.exceptions.LockException:
+        raise RuntimeError(
+            f"Un autre processus écrit déjà dans {STORAGE_DIR} : lancez un seul writer "
+            "et servez les requêtes avec RAG_ROLE=reader"
+        )
+# Configuration ChromaDB : un serveur partagé charge l'index HNSW une seule fois pour tous les workers,
+# sinon base locale (un seul processus doit alors y écrire)
+if CHROMA_HOST:
+    chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT, settings=Settings(allow_reset=True))
+else:
+    chroma_client = chromadb.PersistentClient(path=str(CHROMA_DIR), settings=Settings(allow_reset=True))
 # Modèles de données
 class EmbeddingModel(str, Enum):
     MINILM = "all-MiniLM-L6-v2"
@@ -63,12 +112,14 @@ class QueryRequest(BaseModel):
     max_tokens: int = 1000
     n_context_results: int = 3
     system_prompt: str = "Vous êtes un assistant utile."
+    priority: Priority = Priority.INTERACTIVE
 
 # Configuration Groq
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "") # Remplacez par votre clé API Groq
-groq_client = Groq(api_key=GROQ_API_KEY,
+# Les nouvelles tentatives (429, erreurs réseau et 5xx) sont gérées par l'ordonnanceur
+groq_client = AsyncGroq(api_key=GROQ_API_KEY,
     timeout=60.0,
-    max_retries=3) if GROQ_API_KEY else None
+    max_retries=0) if GROQ_API_KEY else None
 
 # Modèles disponibles
 GROQ_MODELS = {
@@ -78,6 +129,35 @@ GROQ_MODELS = {
     
 }
 
+# Limites Groq par modèle (requêtes et tokens par minute)
+GROQ_RATE_LIMITS = {
+    "deepseek-r1-distill-llama-70b": ModelLimits(requests_per_minute=30, tokens_per_minute=6000),
+    "llama3-8b-8192": ModelLimits(requests_per_minute=30, tokens_per_minute=30000),
+    "llama3-70b-8192": ModelLimits(requests_per_minute=30, tokens_per_minute=6000)
+}
+# Limites d'un compte payant, ex. {"llama3-8b-8192": {"requests_per_minute": 14400, "tokens_per_minute": 1000000}}
+GROQ_RATE_LIMITS.update({
+    model: ModelLimits(**limits)
+    for model, limits in json.loads(os.getenv("GROQ_RATE_LIMITS", "{}")).items()
+})
+# Chaque worker ne dispose que de sa part des limites du compte Groq
+GROQ_RATE_LIMITS = {model: limits.per_worker(RAG_QUERY_WORKERS) for model, limits in GROQ_RATE_LIMITS.items()}
+
+# Modèle plus petit utilisé quand la file du modèle demandé est trop longue
+GROQ_FALLBACKS = {
+    "DeepSeek-Llama-70B": "Llama3-8B",
+    "Llama3-70B": "Llama3-8B"
+}
+
+groq_scheduler = GroqScheduler(
+    groq_client,
+    limits=GROQ_RATE_LIMITS,
+    fallbacks={GROQ_MODELS[src]: GROQ_MODELS[dst] for src, dst in GROQ_FALLBACKS.items()},
+    config=SchedulerConfig(hedge_enabled=os.getenv("GROQ_HEDGING", "0") == "1"),
+    is_rate_limit_error=lambda e: isinstance(e, RateLimitError),
+    is_transient_error=lambda e: isinstance(e, (APIConnectionError, InternalServerError))
+) if groq_client else None
+
 DEEPSEEK_MODELS = {
     "DeepSeek-7B": "deepseek-ai/deepseek-llm-7b",
     "DeepSeek-67B": "deepseek-ai/deepseek-llm-67b",
@@ -88,8 +168,36 @@ DEEPSEEK_MODELS = {
 # Cache pour les modèles HuggingFace
 hf_pipelines = {}
 chroma_collections = {} 
+# Sérialise les lectures-modifications-écritures de themes.json dans le writer
+themes_lock = asyncio.Lock()
+# Copie des thèmes récupérée auprès du writer (readers multi-nœuds), rafraîchie en tâche de fond
+remote_themes_cache = {"themes": {}}
+themes_refresh_task: Optional[asyncio.Task] = None
 # Fonctions d'aide
+def fetch_remote_themes() -> bool:
+    """Récupère les thèmes auprès du writer ; en cas d'échec, la copie précédente est conservée"""
+    try:
+        resp = requests.get(f"{RAG_WRITER_URL}/themes/state", timeout=5)
+        resp.raise_for_status()
+        remote_themes_cache["themes"] = resp.json()
+        return True
+    except Exception as e:
+        logger.error(f"Error fetching themes from writer: {str(e)}")
+        return False
+
+async def refresh_remote_themes():
+    """Boucle de rafraîchissement des thèmes, avec backoff tant que le writer est indisponible"""
+    delay = THEMES_REFRESH_SECONDS
+    while True:
+        await asyncio.sleep(delay)
+        if await asyncio.to_thread(fetch_remote_themes):
+            delay = THEMES_REFRESH_SECONDS
+        else:
+            delay = min(delay * 2, THEMES_MAX_BACKOFF_SECONDS)
+
 def load_themes() -> Dict[str, Dict]:
+    if RAG_ROLE == ServingRole.READER and RAG_WRITER_URL:
+        return copy.deepcopy(remote_themes_cache["themes"])
     if THEMES_FILE.exists():
         try:
             with open(THEMES_FILE, "r", encoding="utf-8") as f:
@@ -101,8 +209,11 @@ def load_themes() -> Dict[str, Dict]:
 
 def save_themes(themes: Dict[str, Dict]):
     try:
-        with open(THEMES_FILE, "w", encoding="utf-8") as f:
+        # Écriture atomique : les workers qui relisent le fichier ne voient jamais un JSON partiel
+        tmp_file = THEMES_FILE.with_suffix(".json.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
             json.dump(themes, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, THEMES_FILE)
     except Exception as e:
         logger.error(f"Error saving themes: {str(e)}")
         raise
@@ -143,11 +254,18 @@ def get_chroma_collection(theme_name: str, embedding_model: str):
     
     try:
         embedding_fn = get_embedding_function(embedding_model)
-        collection = chroma_client.get_or_create_collection(
-            name=theme_name,
-            embedding_function=embedding_fn,
-            metadata={"hnsw:space": "cosine"}
-        )
+        if RAG_ROLE == ServingRole.READER:
+            # Les readers ne créent jamais de collection : c'est le rôle du writer
+            collection = chroma_client.get_collection(
+                name=theme_name,
+                embedding_function=embedding_fn
+            )
+        else:
+            collection = chroma_client.get_or_create_collection(
+                name=theme_name,
+                embedding_function=embedding_fn,
+                metadata={"hnsw:space": "cosine"}
+            )
         chroma_collections[theme_name] = collection
         return collection
     except Exception as e:
@@ -189,12 +307,49 @@ def get_context_from_chroma(theme_name: str, query: str, n_results: int = 3) ->
         return f"Erreur lors de la récupération du contexte: {str(e)}"
 
 
+def warm_up_collections():
+    """Charge une fois par reader les collections (et modèles d'embedding) des thèmes existants"""
+    for theme_name, theme in load_themes().items():
+        try:
+            get_chroma_collection(theme_name, theme["embedding_model"])
+        except Exception as e:
+            logger.error(f"Erreur préchargement du thème {theme_name}: {str(e)}")
+
+async def start_reader():
+    """Démarre la synchronisation des thèmes et précharge les collections des readers"""
+    global themes_refresh_task
+    if RAG_ROLE != ServingRole.READER:
+        return
+    if RAG_WRITER_URL:
+        await asyncio.to_thread(fetch_remote_themes)
+        themes_refresh_task = asyncio.create_task(refresh_remote_themes())
+    await asyncio.to_thread(warm_up_collections)
+
+def stop_reader():
+    if themes_refresh_task:
+        themes_refresh_task.cancel()
+
+def require_writer():
+    """Refuse les écritures sur les workers de requêtes"""
+    if RAG_ROLE == ServingRole.READER:
+        raise HTTPException(
+            status_code=403,
+            detail={
+                "error": "Worker en lecture seule, envoyez les écritures au processus d'indexation",
+                "writer_url": RAG_WRITER_URL
+            }
+        )
+
     
 # Endpoints
 # Endpoints
-@app.post("/theme")
+@app.post("/theme", dependencies=[Depends(require_writer)])
 async def create_theme(theme: ThemeCreate):
     """Crée un nouveau thème avec son modèle d'embedding"""
+    async with themes_lock:
+        return await _create_theme(theme)
+
+async def _create_theme(theme: ThemeCreate):
     themes = load_themes()
     theme_name = theme.name.strip().lower().replace(" ", "_")
     
@@ -235,12 +390,21 @@ async def get_themes():
         ]
     }
 
-@app.post("/theme/{theme_name}/upload")
+@app.get("/themes/state")
+async def get_themes_state():
+    """Contenu brut de themes.json, lu par les workers de requêtes"""
+    return load_themes()
+
+@app.post("/theme/{theme_name}/upload", dependencies=[Depends(require_writer)])
 async def upload_files(
     theme_name: str,
     files: List[UploadFile] = File(...)
 ):
     """Upload et indexe des fichiers dans un thème spécifique"""
+    async with themes_lock:
+        return await _upload_files(theme_name, files)
+
+async def _upload_files(theme_name: str, files: List[UploadFile]):
     themes = load_themes()
     if theme_name not in themes:
         raise HTTPException(status_code=404, detail="Thème non trouvé")
@@ -323,7 +487,9 @@ async def handle_query(query: QueryRequest):
     try:
         # Récupération du contexte avec validation
         try:
-            context = get_context_from_chroma(
+            # Embedding de la question et aller-retour Chroma hors de la boucle d'événements
+            context = await asyncio.to_thread(
+                get_context_from_chroma,
                 theme_name=query.theme,
                 query=query.question,
                 n_results=query.n_context_results
@@ -348,7 +514,7 @@ async def handle_query(query: QueryRequest):
 
         if query.llm_provider == LLMProvider.GROQ:
             # Validation Groq
-            if not groq_client:
+            if not groq_scheduler:
                 logger.error("Client Groq non initialisé")
                 raise HTTPException(
                     status_code=500,
@@ -374,21 +540,35 @@ async def handle_query(query: QueryRequest):
             ]
 
             try:
-                # Appel à l'API Groq avec timeout
-                response = groq_client.chat.completions.create(
+                # Appel à l'API Groq via l'ordonnanceur (limites de débit, priorité, repli)
+                response, served_model, queue_wait = await groq_scheduler.create(
                     model=groq_model,
                     messages=messages,
-                    temperature=query.temperature,
                     max_tokens=query.max_tokens,
+                    priority=query.priority,
+                    temperature=query.temperature,
                     timeout=30  # Timeout en secondes
                 )
                 answer = response.choices[0].message.content
                 response_data["answer"] = answer
+                if served_model != groq_model:
+                    response_data["model"] = next(
+                        name for name, model_id in GROQ_MODELS.items() if model_id == served_model
+                    )
+                    response_data["fallback_from"] = query.llm_model
+                response_data["queue_wait"] = queue_wait
                 response_data["usage"] = {
                     "prompt_tokens": response.usage.prompt_tokens,
                     "completion_tokens": response.usage.completion_tokens
                 }
 
+            except SchedulerOverloadedError as e:
+                logger.warning(f"Requête Groq rejetée: {str(e)}")
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Service Groq saturé: {str(e)}",
+                    headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+                )
             except Exception as e:
                 logger.error(f"Erreur API Groq: {str(e)}", exc_info=True)
                 raise HTTPException(
@@ -437,6 +617,13 @@ async def list_available_models():
         }
     }
 
+@app.get("/scheduler/metrics")
+async def get_scheduler_metrics():
+    """Profondeur des files et temps d'attente par modèle Groq"""
+    if not groq_scheduler:
+        raise HTTPException(status_code=500, detail="Configuration Groq manquante")
+    return {"models": groq_scheduler.metrics()}
+
 @app.get("/theme/{theme_name}/documents")
 async def list_theme_documents(theme_name: str):
     """Liste les documents d'un thème spécifique"""
@@ -472,4 +659,6 @@ def initialize_models():
             logger.error(f"Erreur chargement {model_name}: {str(e)}")
 
 # Appeler au démarrage (dans le __main__ ou à l'initialisation)
-initialize_models()
\ No newline at end of file
+# Les readers ne chargent que les modèles de leurs thèmes (voir warm_up_collections)
+if RAG_ROLE != ServingRole.READER:
+    initialize_models()
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""Mesure le débit de /query sur N workers readers (`RAG_ROLE=reader`), avec un LLM factice.
+
+Prérequis : un serveur Chroma et un writer dont au moins un thème est indexé.
+
+    chroma run --path storage/chroma_db --port 8001
+    RAG_ROLE=writer CHROMA_HOST=localhost uvicorn api:app --port 8000
+    python bench_readers.py --theme diabete --workers 1,2,4
+
+Le script démarre un faux serveur Groq (latence fixe, sans limite de débit) puis, pour chaque
+nombre de workers, lance `uvicorn api:app --workers N` en reader et envoie des /query en
+parallèle. La recherche vectorielle passe toujours par l'unique serveur Chroma, qui plafonne
+le débit de récupération : ajouter des readers ne répartit que l'embedding des questions et
+l'attente du LLM.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+BASE_DIR = Path(__file__).parent
+BENCH_QUESTIONS = [
+    "Quels sont les symptômes du diabète de type 2 ?",
+    "Comment surveiller sa glycémie au quotidien ?",
+    "Quels aliments privilégier en cas de diabète ?",
+    "Quelle activité physique est recommandée ?",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Débit de /query sur des workers readers")
+    parser.add_argument("--theme", required=True, help="Thème déjà indexé par le writer")
+    parser.add_argument("--workers", default="1,2,4", help="Nombres de workers à mesurer")
+    parser.add_argument("--writer-url", default="http://localhost:8000")
+    parser.add_argument("--chroma-host", default="localhost")
+    parser.add_argument("--chroma-port", type=int, default=8001)
+    parser.add_argument("--reader-port", type=int, default=8010)
+    parser.add_argument("--llm-port", type=int, default=8020)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Latence du faux LLM (s)")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requêtes /query simultanées")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Durée de chauffe avant mesure (s)")
+    parser.add_argument("--duration", type=float, default=20.0, help="Durée de chaque mesure (s)")
+    return parser.parse_args()
+
+
+def start_fake_llm(port: int, latency: float):
+    """Serveur compatible avec l'API chat completions de Groq, qui répond après `latency` secondes"""
+    app = FastAPI()
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(body: Dict):
+        await asyncio.sleep(latency)
+        return {
+            "id": "bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "Réponse factice."},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110}
+        }
+
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.1)
+
+
+def start_readers(args, workers: int) -> subprocess.Popen:
+    # Limites Groq sans effet : seul le débit des readers est mesuré
+    unlimited = {"requests_per_minute": 10 ** 7, "tokens_per_minute": 10 ** 9}
+    env = dict(
+        os.environ,
+        RAG_ROLE="reader",
+        CHROMA_HOST=args.chroma_host,
+        CHROMA_PORT=str(args.chroma_port),
+        RAG_WRITER_URL=args.writer_url,
+        RAG_QUERY_WORKERS=str(workers),
+        GROQ_API_KEY="bench",
+        GROQ_BASE_URL=f"http://localhost:{args.llm_port}",
+        GROQ_RATE_LIMITS=json.dumps({model: unlimited for model in (
+            "deepseek-r1-distill-llama-70b", "llama3-8b-8192", "llama3-70b-8192"
+        )}),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(args.reader_port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=BASE_DIR, env=env
+    )
+
+
+async def wait_until_ready(url: str, timeout: float = 600):
+    started_at = time.monotonic()
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() - started_at < timeout:
+            try:
+                if (await client.get(f"{url}/themes", timeout=5)).json()["themes"]:
+                    return
+            except (httpx.HTTPError, ValueError, KeyError):
+                pass
+            await asyncio.sleep(1)
+    raise RuntimeError(f"Les readers ne répondent pas sur {url}")
+
+
+async def load(url: str, args, duration: float) -> Dict[str, int]:
+    """Envoie des /query depuis `args.concurrency` clients pendant `duration` secondes"""
+    counts = {"ok": 0, "errors": 0}
+    deadline = time.monotonic() + duration
+
+    async def client_loop(client: httpx.AsyncClient, index: int):
+        while time.monotonic() < deadline:
+            resp = await client.post(f"{url}/query", json={
+                "theme": args.theme,
+                "question": BENCH_QUESTIONS[index % len(BENCH_QUESTIONS)],
+                "llm_provider": "Groq",
+                "llm_model": "Llama3-8B",
+                "max_tokens": 50
+            }, timeout=60)
+            counts["ok" if resp.status_code == 200 else "errors"] += 1
+            index += 1
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits) as client:
+        await asyncio.gather(*[client_loop(client, i) for i in range(args.concurrency)])
+    return counts
+
+
+def measure(args, workers: int) -> Dict[str, float]:
+    url = f"http://localhost:{args.reader_port}"
+    process = start_readers(args, workers)
+    try:
+        asyncio.run(wait_until_ready(url))
+        asyncio.run(load(url, args, args.warmup))
+        counts = asyncio.run(load(url, args, args.duration))
+    finally:
+        process.terminate()
+        process.wait()
+    return {"throughput": counts["ok"] / args.duration, "errors": counts["errors"]}
+
+
+def main():
+    args = parse_args()
+    start_fake_llm(args.llm_port, args.llm_latency)
+
+    results = {int(w): measure(args, int(w)) for w in args.workers.split(",")}
+
+    baseline_workers = min(results)
+    baseline = results[baseline_workers]["throughput"] / baseline_workers
+    print(f"{'workers':>8} {'requêtes/s':>12} {'accélération':>13} {'efficacité':>11} {'erreurs':>8}")
+    for workers, result in results.items():
+        speedup = result["throughput"] / baseline if baseline else 0.0
+        print(f"{workers:>8} {result['throughput']:>12.1f} {speedup:>13.2f} "
+              f"{speedup / workers:>11.0%} {result['errors']:>8}")
+    print(f"(CPU disponibles : {os.cpu_count()}, latence LLM : {args.llm_latency}s, "
+          f"{args.concurrency} clients)")
+
+
+if __name__ == "__main__":
+    main()
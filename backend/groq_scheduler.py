@@ -0,0 +1,446 @@
+"""Ordonnanceur des appels Groq : limites de débit, priorités, repli et requêtes couvertes."""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(str, Enum):
+    """Classe de priorité d'une requête"""
+    INTERACTIVE = "interactive"
+    BATCH = "batch"
+
+
+# Rang dans la file : plus petit = servi en premier
+PRIORITY_RANK = {Priority.INTERACTIVE: 0, Priority.BATCH: 1}
+
+
+class SchedulerOverloadedError(Exception):
+    """Aucun modèle ne peut servir la requête dans le délai toléré pour sa priorité"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class ModelLimits:
+    """Limites Groq d'un modèle : requêtes et tokens par minute"""
+    requests_per_minute: int
+    tokens_per_minute: int
+
+    def per_worker(self, workers: int) -> "ModelLimits":
+        """Part des limites revenant à un processus quand `workers` processus partagent la clé API"""
+        return ModelLimits(
+            requests_per_minute=max(1, self.requests_per_minute // workers),
+            tokens_per_minute=max(1, self.tokens_per_minute // workers),
+        )
+
+
+@dataclass
+class SchedulerConfig:
+    """Paramètres de l'ordonnanceur"""
+    # Attente maximale tolérée en file : au-delà, repli sur un modèle plus petit ou rejet
+    max_queue_wait: Dict[Priority, float] = field(default_factory=lambda: {
+        Priority.INTERACTIVE: 5.0,
+        Priority.BATCH: 60.0,
+    })
+    # Profondeur de file à partir de laquelle on bascule sur le modèle de repli
+    max_queue_depth: int = 8
+    # Requêtes couvertes (hedging) : une seconde requête n'est envoyée que si la première
+    # dépasse le p95 des latences observées pour le modèle
+    hedge_enabled: bool = False
+    hedge_min_samples: int = 20
+    hedge_min_delay: float = 1.0
+    # Nouvelles tentatives après un 429 renvoyé par Groq
+    max_rate_limit_retries: int = 2
+    # Nouvelles tentatives (backoff exponentiel) après une erreur réseau ou 5xx
+    max_transient_retries: int = 2
+    transient_backoff: float = 0.5
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """Estimation grossière du nombre de tokens du prompt (~4 caractères par token)"""
+    chars = sum(len(m.get("content", "")) for m in messages)
+    return chars // 4 + 4 * len(messages)
+
+
+class TokenBucket:
+    """Seau à jetons rechargé en continu"""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def delay(self, amount: float, clamp: bool = True) -> float:
+        """Temps (en secondes) avant que `amount` jetons soient disponibles"""
+        self._refill()
+        if clamp:
+            amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.refill_per_second)
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        """Rend des jetons consommés pour une requête que l'API n'a pas facturée"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+    def drain(self, seconds: float):
+        """Vide le seau pour imposer une pause (ex. après un 429)"""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.refill_per_second)
+
+
+@dataclass
+class ModelMetrics:
+    requests: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    total_wait_time: float = 0.0
+    max_wait_time: float = 0.0
+    fallbacks: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    rate_limited: int = 0
+    rejected: int = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=200))
+
+    def latency_p95(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "avg_wait_time": self.total_wait_time / self.requests if self.requests else 0.0,
+            "max_wait_time": self.max_wait_time,
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "rate_limited": self.rate_limited,
+            "rejected": self.rejected,
+            "latency_p95": self.latency_p95(),
+        }
+
+
+class ModelQueue:
+    """File prioritaire protégée par les seaux requêtes/tokens d'un modèle"""
+
+    def __init__(self, limits: ModelLimits):
+        self.requests = TokenBucket(limits.requests_per_minute, limits.requests_per_minute / 60)
+        self.tokens = TokenBucket(limits.tokens_per_minute, limits.tokens_per_minute / 60)
+        self.metrics = ModelMetrics()
+        self._waiters: List[tuple] = []  # tas de (priorité, séquence, coût)
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+        self._background: set = set()
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    def _delay(self, cost: int) -> float:
+        return max(self.requests.delay(1), self.tokens.delay(cost))
+
+    def estimated_wait(self, cost: int, priority: Priority) -> float:
+        """Attente estimée pour une nouvelle requête, en tenant compte des requêtes prioritaires en file"""
+        ahead = [w for w in self._waiters if w[0] <= PRIORITY_RANK[priority]]
+        return max(
+            self.requests.delay(len(ahead) + 1, clamp=False),
+            # `consume` plafonne le coût d'une requête à la capacité du seau
+            self.tokens.delay(sum(min(w[2], self.tokens.capacity) for w in ahead + [(0, 0, cost)]), clamp=False),
+        )
+
+    def try_acquire(self, cost: int) -> bool:
+        """Réserve immédiatement la capacité si personne n'attend et que les seaux le permettent"""
+        if self._waiters or self._delay(cost) > 0:
+            return False
+        self.requests.consume(1)
+        self.tokens.consume(cost)
+        return True
+
+    async def acquire(self, cost: int, priority: Priority, deadline: Optional[float] = None) -> float:
+        """Attend son tour puis réserve la capacité ; retourne le temps passé en file.
+
+        Lève `SchedulerOverloadedError` si `deadline` (horloge monotonic) est dépassée avant d'être servi.
+        """
+        ticket = (PRIORITY_RANK[priority], next(self._seq), cost)
+        enqueued_at = time.monotonic()
+        # Le ticket est visible dans la file avant même d'obtenir le verrou, pour que
+        # `estimated_wait` compte toutes les requêtes en attente
+        heapq.heappush(self._waiters, ticket)
+        self.metrics.queue_depth = self.depth
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.depth)
+        try:
+            async with self._cond:
+                try:
+                    while True:
+                        now = time.monotonic()
+                        timeout = None if deadline is None else deadline - now
+                        delay = self._delay(cost) if self._waiters[0] == ticket else None
+                        if delay is not None and delay <= 0:
+                            self.requests.consume(1)
+                            self.tokens.consume(cost)
+                            break
+                        # En tête de file l'attente restante est connue : inutile d'attendre l'échéance
+                        if timeout is not None and (timeout <= 0 or (delay is not None and delay > timeout)):
+                            self.metrics.rejected += 1
+                            raise SchedulerOverloadedError(
+                                "Délai d'attente en file dépassé",
+                                retry_after=self.estimated_wait(cost, priority)
+                            )
+                        if delay is not None:
+                            timeout = delay if timeout is None else min(timeout, delay)
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), timeout)
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    self._remove(ticket)
+                    self._cond.notify_all()
+        except BaseException:
+            # Annulation pendant l'attente du verrou : le ticket est encore en file
+            if ticket in self._waiters:
+                self._remove(ticket)
+                task = asyncio.ensure_future(self._wake_up())
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            raise
+
+        waited = time.monotonic() - enqueued_at
+        self.metrics.requests += 1
+        self.metrics.total_wait_time += waited
+        self.metrics.max_wait_time = max(self.metrics.max_wait_time, waited)
+        return waited
+
+    def _remove(self, ticket: tuple):
+        self._waiters.remove(ticket)
+        heapq.heapify(self._waiters)
+        self.metrics.queue_depth = self.depth
+
+    async def _wake_up(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def refund(self, cost: int):
+        """Rend la capacité réservée pour une requête rejetée par Groq"""
+        self.requests.refund(1)
+        self.tokens.refund(cost)
+
+    def penalize(self, retry_after: float, tokens_exhausted: bool = False):
+        """Bloque la file après un 429 jusqu'à la fin de la fenêtre annoncée"""
+        self.metrics.rate_limited += 1
+        self.requests.drain(retry_after)
+        if tokens_exhausted:
+            self.tokens.drain(retry_after)
+
+
+def _is_server_error(error: Exception) -> bool:
+    return (getattr(error, "status_code", None) or 0) >= 500 or isinstance(error, (ConnectionError, TimeoutError))
+
+
+def _retrieve_exception(task: asyncio.Future):
+    """Marque l'exception d'un appel perdant comme lue, pour qu'asyncio ne la signale pas"""
+    if not task.cancelled():
+        task.exception()
+
+
+class GroqScheduler:
+    """Couche d'ordonnancement placée devant les appels `chat.completions.create` d'un client asynchrone"""
+
+    def __init__(
+        self,
+        client,
+        limits: Dict[str, ModelLimits],
+        fallbacks: Optional[Dict[str, str]] = None,
+        config: Optional[SchedulerConfig] = None,
+        is_rate_limit_error: Callable[[Exception], bool] = lambda e: getattr(e, "status_code", None) == 429,
+        is_transient_error: Callable[[Exception], bool] = _is_server_error,
+    ):
+        self.client = client
+        self.queues = {model: ModelQueue(model_limits) for model, model_limits in limits.items()}
+        self.fallbacks = fallbacks or {}
+        self.config = config or SchedulerConfig()
+        self.is_rate_limit_error = is_rate_limit_error
+        self.is_transient_error = is_transient_error
+
+    def _choose_model(self, model: str, cost: int, priority: Priority) -> str:
+        """Choisit le modèle qui servira la requête dans le délai toléré pour sa priorité.
+
+        Bascule sur le modèle de repli si la file du modèle demandé est trop longue, et lève
+        `SchedulerOverloadedError` si aucun des deux ne peut servir la requête à temps.
+        """
+        budget = self.config.max_queue_wait[priority]
+        queue = self.queues[model]
+        wait = queue.estimated_wait(cost, priority)
+        if queue.depth < self.config.max_queue_depth and wait <= budget:
+            return model
+
+        retry_after = wait
+        fallback = self.fallbacks.get(model)
+        if fallback in self.queues:
+            fallback_queue = self.queues[fallback]
+            fallback_wait = fallback_queue.estimated_wait(cost, priority)
+            if fallback_queue.depth < self.config.max_queue_depth and fallback_wait <= min(wait, budget):
+                logger.info(f"File {model} saturée (profondeur={queue.depth}, attente≈{wait:.1f}s), repli sur {fallback}")
+                queue.metrics.fallbacks += 1
+                return fallback
+            retry_after = min(wait, fallback_wait)
+
+        if wait <= budget:
+            return model
+        queue.metrics.rejected += 1
+        raise SchedulerOverloadedError(
+            f"File {model} saturée (attente estimée {wait:.1f}s > {budget:.1f}s)",
+            retry_after=retry_after
+        )
+
+    async def _call(self, model: str, cost: int, kwargs: Dict[str, Any]):
+        """Un appel Groq sur une réservation déjà obtenue ; l'annulation ferme la requête HTTP"""
+        queue = self.queues[model]
+        started_at = time.monotonic()
+        try:
+            response = await self.client.chat.completions.create(model=model, **kwargs)
+        except asyncio.CancelledError:
+            # La latence d'un appel annulé (perdant d'une requête couverte) est au moins celle-ci :
+            # l'ignorer ferait baisser le p95 à chaque requête couverte
+            queue.metrics.latencies.append(time.monotonic() - started_at)
+            raise
+        except Exception as e:
+            if self.is_rate_limit_error(e):
+                # Groq n'a pas facturé la requête rejetée : sa réservation est rendue
+                queue.refund(cost)
+            raise
+        queue.metrics.latencies.append(time.monotonic() - started_at)
+        return response
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        """Délai avant la requête couverte : p95 des latences du modèle, None tant qu'il n'est pas connu"""
+        metrics = self.queues[model].metrics
+        if len(metrics.latencies) < self.config.hedge_min_samples:
+            return None
+        return max(self.config.hedge_min_delay, metrics.latency_p95())
+
+    async def _call_hedged(self, model: str, cost: int, kwargs: Dict[str, Any]):
+        """Envoie une seconde requête si la première tarde, et garde la première réponse"""
+        queue = self.queues[model]
+        hedge_delay = self._hedge_delay(model)
+        if hedge_delay is None:
+            return await self._call(model, cost, kwargs)
+        primary = asyncio.ensure_future(self._call(model, cost, kwargs))
+        primary.add_done_callback(_retrieve_exception)
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        # La requête couverte n'est envoyée que si elle ne prend la place de personne
+        if done or not queue.try_acquire(cost):
+            return await primary
+
+        queue.metrics.hedges += 1
+        hedge = asyncio.ensure_future(self._call(model, cost, kwargs))
+        hedge.add_done_callback(_retrieve_exception)
+        pending = {primary, hedge}
+        try:
+            return await self._first_success(pending, hedge, queue)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _first_success(self, pending: set, hedge: asyncio.Future, queue: ModelQueue):
+        """Première réponse réussie parmi `pending` ; `pending` ne garde que les appels encore en cours"""
+        error = None
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending -= done
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        queue.metrics.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    async def _send(self, model: str, cost: int, kwargs: Dict[str, Any], hedged: bool):
+        """Appel Groq sur la réservation obtenue, relancé avec backoff après une erreur réseau ou 5xx"""
+        for attempt in range(self.config.max_transient_retries + 1):
+            try:
+                if hedged:
+                    return await self._call_hedged(model, cost, kwargs)
+                return await self._call(model, cost, kwargs)
+            except Exception as e:
+                if not self.is_transient_error(e) or attempt == self.config.max_transient_retries:
+                    raise
+                delay = self.config.transient_backoff * 2 ** attempt
+                logger.warning(f"Erreur transitoire Groq sur {model}: {str(e)}, nouvelle tentative dans {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def create(self, model: str, messages: List[Dict[str, str]], max_tokens: int,
+                     priority: Priority = Priority.INTERACTIVE, **kwargs):
+        """Planifie un appel Groq ; retourne (réponse, modèle effectivement utilisé, attente en file)"""
+        if model not in self.queues:
+            raise KeyError(f"Aucune limite configurée pour le modèle {model}")
+        cost = estimate_tokens(messages) + max_tokens
+        model = self._choose_model(model, cost, priority)
+        queue = self.queues[model]
+        kwargs = dict(kwargs, messages=messages, max_tokens=max_tokens)
+
+        deadline = time.monotonic() + self.config.max_queue_wait[priority]
+        waited = 0.0
+        for attempt in range(self.config.max_rate_limit_retries + 1):
+            waited += await queue.acquire(cost, priority, deadline)
+            # Pas de requête couverte après un 429 : le quota vient justement d'être atteint
+            hedged = self.config.hedge_enabled and priority == Priority.INTERACTIVE and attempt == 0
+            try:
+                response = await self._send(model, cost, kwargs, hedged)
+                return response, model, waited
+            except Exception as e:
+                if not self.is_rate_limit_error(e) or attempt == self.config.max_rate_limit_retries:
+                    raise
+                retry_after = _retry_after(e)
+                logger.warning(f"429 Groq sur {model}, pause de {retry_after:.1f}s (tentative {attempt + 1})")
+                queue.penalize(retry_after, tokens_exhausted=_is_token_limit(e))
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {model: queue.metrics.as_dict() for model, queue in self.queues.items()}
+
+
+def _is_token_limit(error: Exception) -> bool:
+    """Vrai si le 429 porte sur les tokens par minute plutôt que sur les requêtes"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("x-ratelimit-remaining-tokens") == "0":
+        return True
+    return "tokens per minute" in str(error).lower() or "(tpm)" in str(error).lower()
+
+
+def _retry_after(error: Exception, default: float = 1.0) -> float:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
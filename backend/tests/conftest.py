@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Les modules du backend s'importent depuis backend/ (uvicorn api:app)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
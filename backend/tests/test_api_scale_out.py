@@ -0,0 +1,197 @@
+import asyncio
+import importlib.util
+import json
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+chromadb = pytest.importorskip("chromadb")
+huggingface_hub = pytest.importorskip("huggingface_hub")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("groq")
+pytest.importorskip("portalocker")
+from chromadb import Documents, EmbeddingFunction, Embeddings  # noqa: E402
+from chromadb.config import Settings  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+API_PATH = Path(__file__).resolve().parent.parent / "api.py"
+WRITER_URL = "http://writer.test"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+
+class LetterEmbedding(EmbeddingFunction):
+    """Embedding déterministe (initiales des mots), sans téléchargement de modèle"""
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [
+            [0.01 + sum(word.startswith(letter) for word in text.lower().split()) for letter in "abcdefghijklmnopqrstuvwxyz"]
+            for text in input
+        ]
+
+
+class StopRefresh(Exception):
+    pass
+
+
+@pytest.fixture
+def chroma_server(monkeypatch):
+    """Serveur Chroma de substitution : un client en mémoire partagé par tous les processus simulés"""
+    server = chromadb.EphemeralClient(settings=Settings(allow_reset=True))
+    server.reset()
+    monkeypatch.setattr(chromadb, "HttpClient", lambda **kwargs: server)
+    return server
+
+
+@pytest.fixture
+def load_api(monkeypatch, tmp_path, chroma_server):
+    """Importe une instance indépendante de api.py, comme un processus lancé avec RAG_ROLE=`role`"""
+    modules = []
+    monkeypatch.setenv("HF_TOKEN", "")
+    monkeypatch.setattr(huggingface_hub, "login", lambda **kwargs: None)
+    monkeypatch.setitem(sys.modules, "sentence_transformers",
+                        SimpleNamespace(SentenceTransformer=lambda *args, **kwargs: None))
+
+    def load(role, chroma_host="localhost", writer_url=None, storage="storage"):
+        monkeypatch.setenv("RAG_ROLE", role)
+        monkeypatch.setenv("RAG_STORAGE_DIR", str(tmp_path / storage))
+        monkeypatch.delenv("GROQ_API_KEY", raising=False)
+        for key, value in (("CHROMA_HOST", chroma_host), ("RAG_WRITER_URL", writer_url)):
+            if value:
+                monkeypatch.setenv(key, value)
+            else:
+                monkeypatch.delenv(key, raising=False)
+
+        name = f"api_{role}_{len(modules)}"
+        spec = importlib.util.spec_from_file_location(name, API_PATH)
+        module = importlib.util.module_from_spec(spec)
+        monkeypatch.setitem(sys.modules, name, module)
+        spec.loader.exec_module(module)
+        modules.append(module)
+        monkeypatch.setattr(module, "get_embedding_function", lambda model_name: LetterEmbedding())
+        return module
+
+    yield load
+    for module in modules:
+        if module.writer_lock_file:
+            module.writer_lock_file.close()
+
+
+def fake_response(payload):
+    return SimpleNamespace(raise_for_status=lambda: None, json=lambda: payload)
+
+
+def test_reader_refuses_writes(load_api):
+    reader = load_api("reader")
+    client = TestClient(reader.app)
+
+    resp = client.post("/theme", json={"name": "Diabete", "embedding_model": EMBEDDING_MODEL})
+    assert resp.status_code == 403
+    resp = client.post("/theme/diabete/upload", files=[("files", ("a.txt", b"texte", "text/plain"))])
+    assert resp.status_code == 403
+
+
+def test_reader_serves_writer_index_through_shared_chroma(load_api, monkeypatch):
+    writer = load_api("writer")
+    writer_client = TestClient(writer.app)
+    assert writer_client.post("/theme", json={"name": "Diabete", "embedding_model": EMBEDDING_MODEL}).status_code == 200
+    resp = writer_client.post(
+        "/theme/diabete/upload",
+        files=[("files", ("insuline.txt", b"insulin regulates blood glucose", "text/plain"))]
+    )
+    assert resp.json()["saved_files"] == ["insuline.txt"]
+
+    # Le reader n'a pas accès au stockage du writer : il ne voit les thèmes qu'à travers RAG_WRITER_URL
+    reader = load_api("reader", writer_url=WRITER_URL, storage="reader_storage")
+    monkeypatch.setattr(reader, "requests", SimpleNamespace(
+        get=lambda url, timeout: writer_client.get(url[len(WRITER_URL):])
+    ))
+    with TestClient(reader.app) as reader_client:
+        themes = reader_client.get("/themes").json()["themes"]
+        assert [(t["name"], t["documents_count"]) for t in themes] == [("diabete", 1)]
+        assert "diabete" in reader.chroma_collections  # préchargé au démarrage
+        context = reader.get_context_from_chroma("diabete", "blood glucose", n_results=1)
+    assert "insulin regulates blood glucose" in context
+    assert reader.themes_refresh_task.cancelled()
+
+
+def test_collections_created_by_writer_only(load_api, chroma_server):
+    writer = load_api("writer")
+    reader = load_api("reader")
+
+    with pytest.raises(HTTPException):
+        reader.get_chroma_collection("absent", EMBEDDING_MODEL)
+    writer.get_chroma_collection("nouveau", EMBEDDING_MODEL)
+    assert [c.name for c in chroma_server.list_collections()] == ["nouveau"]
+
+
+def test_reader_keeps_last_themes_while_writer_is_down(load_api, monkeypatch):
+    reader = load_api("reader", writer_url=WRITER_URL)
+    themes = {"diabete": {"embedding_model": EMBEDDING_MODEL, "documents": []}}
+    responses = [fake_response(themes), ConnectionError("writer indisponible")]
+
+    def get(url, timeout):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(reader, "requests", SimpleNamespace(get=get))
+    assert reader.fetch_remote_themes() is True
+    # load_themes renvoie une copie : la modifier ne touche pas au cache
+    reader.load_themes()["diabete"]["documents"].append("doc")
+    assert reader.fetch_remote_themes() is False
+    assert reader.load_themes() == themes
+
+
+def test_refresh_backs_off_while_writer_is_down(load_api, monkeypatch):
+    reader = load_api("reader", writer_url=WRITER_URL)
+    fetch_results = [False, False, False, False, True]
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 6:
+            raise StopRefresh()
+
+    async def to_thread(function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    monkeypatch.setattr(reader, "asyncio", SimpleNamespace(sleep=sleep, to_thread=to_thread))
+    monkeypatch.setattr(reader, "fetch_remote_themes", lambda: fetch_results.pop(0))
+    monkeypatch.setattr(reader, "THEMES_REFRESH_SECONDS", 1.0)
+    monkeypatch.setattr(reader, "THEMES_MAX_BACKOFF_SECONDS", 8.0)
+
+    with pytest.raises(StopRefresh):
+        asyncio.run(reader.refresh_remote_themes())
+    assert delays == [1.0, 2.0, 4.0, 8.0, 8.0, 1.0]
+
+
+def test_save_themes_is_atomic(load_api, monkeypatch):
+    writer = load_api("writer")
+    writer.save_themes({"diabete": {"documents": []}})
+
+    def interrupted_dump(themes, f, **kwargs):
+        f.write('{"partiel": ')
+        raise OSError("disque plein")
+
+    monkeypatch.setattr(writer, "json", SimpleNamespace(dump=interrupted_dump, load=json.load))
+    with pytest.raises(OSError):
+        writer.save_themes({"autre": {}})
+    assert json.loads(writer.THEMES_FILE.read_text(encoding="utf-8")) == {"diabete": {"documents": []}}
+
+
+def test_second_writer_refuses_to_start(load_api):
+    load_api("writer")
+    with pytest.raises(RuntimeError, match="Un autre processus"):
+        load_api("writer")
+    with pytest.raises(RuntimeError, match="Un autre processus"):
+        load_api("standalone", chroma_host=None)
+
+
+def test_writer_requires_chroma_server(load_api):
+    with pytest.raises(RuntimeError, match="CHROMA_HOST"):
+        load_api("writer", chroma_host=None)
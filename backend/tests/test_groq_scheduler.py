@@ -0,0 +1,284 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from groq_scheduler import (
+    GroqScheduler,
+    ModelLimits,
+    ModelQueue,
+    Priority,
+    SchedulerConfig,
+    SchedulerOverloadedError,
+    estimate_tokens,
+)
+
+MESSAGES = [{"role": "user", "content": "x" * 40}]
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+    def __init__(self, message="Rate limit reached on requests per minute (RPM)", retry_after="0.1"):
+        super().__init__(message)
+        self.response = SimpleNamespace(headers={"retry-after": retry_after})
+
+
+class ServerError(Exception):
+    status_code = 503
+
+
+class StubClient:
+    """Client Groq asynchrone factice : le n-ième appel dure `delays[n]` puis lève `errors[n]` ou renvoie le modèle"""
+
+    def __init__(self, errors=None, delays=None):
+        self.chat = SimpleNamespace(completions=self)
+        self.calls = []
+        self.cancelled = 0
+        self.errors = list(errors or [])
+        self.delays = list(delays or [])
+
+    async def create(self, model, **kwargs):
+        self.calls.append(model)
+        delay = self.delays.pop(0) if self.delays else 0
+        error = self.errors.pop(0) if self.errors else None
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if error:
+            raise error
+        return model
+
+
+def hedging_scheduler(client, **limits):
+    """Ordonnanceur avec requêtes couvertes actives et un historique de latences de 50 ms"""
+    scheduler = GroqScheduler(
+        client,
+        {"m": ModelLimits(**(limits or {"requests_per_minute": 600, "tokens_per_minute": 100000}))},
+        config=SchedulerConfig(hedge_enabled=True, hedge_min_samples=3, hedge_min_delay=0.05),
+    )
+    scheduler.queues["m"].metrics.latencies.extend([0.05, 0.05, 0.05])
+    return scheduler
+
+
+def exhaust(queue: ModelQueue, seconds: float):
+    """Vide le seau de requêtes pour qu'une requête ne soit servie qu'après `seconds`"""
+    queue.requests.tokens = 1 - seconds * queue.requests.refill_per_second
+
+
+def test_interactive_overtakes_batch_head_in_timed_wait():
+    async def scenario():
+        queue = ModelQueue(ModelLimits(requests_per_minute=600, tokens_per_minute=100000))
+        exhaust(queue, 0.1)
+        order = []
+
+        async def request(name, priority):
+            await queue.acquire(10, priority)
+            order.append(name)
+
+        batch = asyncio.ensure_future(request("batch", Priority.BATCH))
+        await asyncio.sleep(0.02)  # le ticket batch est en tête, en attente temporisée
+        interactive = asyncio.ensure_future(request("interactive", Priority.INTERACTIVE))
+        await asyncio.wait_for(asyncio.gather(batch, interactive), 2)
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive", "batch"]
+
+
+def test_cancelled_head_does_not_strand_other_waiters():
+    async def scenario():
+        queue = ModelQueue(ModelLimits(requests_per_minute=600, tokens_per_minute=100000))
+        exhaust(queue, 0.2)
+        head = asyncio.ensure_future(queue.acquire(10, Priority.INTERACTIVE))
+        await asyncio.sleep(0.01)
+        other = asyncio.ensure_future(queue.acquire(10, Priority.BATCH))
+        await asyncio.sleep(0.05)
+        head.cancel()
+        await asyncio.wait_for(other, 1)
+        return queue.depth
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_ticket_past_deadline_is_dropped():
+    async def scenario():
+        queue = ModelQueue(ModelLimits(requests_per_minute=600, tokens_per_minute=100000))
+        exhaust(queue, 0.5)
+        head = asyncio.ensure_future(queue.acquire(10, Priority.INTERACTIVE))
+        await asyncio.sleep(0.01)
+        started_at = time.monotonic()
+        with pytest.raises(SchedulerOverloadedError):
+            await queue.acquire(10, Priority.INTERACTIVE, deadline=time.monotonic() + 0.1)
+        elapsed = time.monotonic() - started_at
+        depth = queue.depth
+        await head
+        return elapsed, depth, queue.metrics.rejected
+
+    elapsed, depth, rejected = asyncio.run(scenario())
+    assert elapsed < 0.4
+    assert depth == 1
+    assert rejected == 1
+
+
+def test_head_rejected_immediately_when_delay_exceeds_deadline():
+    async def scenario():
+        queue = ModelQueue(ModelLimits(requests_per_minute=60, tokens_per_minute=100000))
+        exhaust(queue, 5)
+        started_at = time.monotonic()
+        with pytest.raises(SchedulerOverloadedError) as excinfo:
+            await queue.acquire(10, Priority.INTERACTIVE, deadline=time.monotonic() + 1)
+        return time.monotonic() - started_at, excinfo.value.retry_after, queue.depth
+
+    elapsed, retry_after, depth = asyncio.run(scenario())
+    assert elapsed < 0.1
+    assert retry_after > 1
+    assert depth == 0
+
+
+def test_fallback_when_primary_queue_is_saturated():
+    async def scenario():
+        scheduler = GroqScheduler(
+            StubClient(),
+            {"big": ModelLimits(60, 100000), "small": ModelLimits(600, 100000)},
+            fallbacks={"big": "small"},
+        )
+        exhaust(scheduler.queues["big"], 30)
+        return await scheduler.create("big", MESSAGES, max_tokens=10)
+
+    response, model, _ = asyncio.run(scenario())
+    assert response == model == "small"
+
+
+def test_rejects_when_no_model_can_serve_in_time():
+    async def scenario():
+        client = StubClient()
+        scheduler = GroqScheduler(client, {"small": ModelLimits(60, 100000)})
+        exhaust(scheduler.queues["small"], 30)
+        with pytest.raises(SchedulerOverloadedError) as excinfo:
+            await scheduler.create("small", MESSAGES, max_tokens=10)
+        # Une requête batch tolère une attente plus longue
+        scheduler.config.max_queue_wait[Priority.BATCH] = 60
+        batch = asyncio.ensure_future(scheduler.create("small", MESSAGES, max_tokens=10, priority=Priority.BATCH))
+        await asyncio.sleep(0.05)
+        queued = scheduler.queues["small"].depth
+        batch.cancel()
+        await asyncio.gather(batch, return_exceptions=True)
+        return excinfo.value.retry_after, client.calls, queued, scheduler.queues["small"].depth
+
+    retry_after, calls, queued, depth = asyncio.run(scenario())
+    assert retry_after > 5
+    assert calls == []
+    assert queued == 1
+    assert depth == 0
+
+
+def test_rate_limit_retry_does_not_charge_tokens_twice():
+    async def scenario():
+        client = StubClient(errors=[RateLimited(), None])
+        scheduler = GroqScheduler(client, {"m": ModelLimits(6000, 600)})
+        result = await scheduler.create("m", MESSAGES, max_tokens=300)
+        return result, client.calls, scheduler.queues["m"]
+
+    (response, _, waited), calls, queue = asyncio.run(scenario())
+    cost = estimate_tokens(MESSAGES) + 300
+    queue.tokens._refill()
+    assert response == "m"
+    assert calls == ["m", "m"]
+    assert waited >= 0.05  # pause imposée par le retry-after
+    assert 600 - cost <= queue.tokens.tokens < 600 - cost + 10
+    assert queue.metrics.rate_limited == 1
+
+
+def test_token_rate_limit_drains_token_bucket():
+    queue = ModelQueue(ModelLimits(6000, 600))
+    queue.penalize(1.0)
+    assert queue.tokens.delay(100) == 0
+    queue.penalize(1.0, tokens_exhausted=True)
+    assert queue.tokens.delay(100) > 1
+
+
+def test_hedging_waits_for_latency_samples_then_uses_p95():
+    async def scenario():
+        client = StubClient(delays=[0.3, 0.3, 0.0])
+        scheduler = GroqScheduler(
+            client,
+            {"m": ModelLimits(600, 100000)},
+            config=SchedulerConfig(hedge_enabled=True, hedge_min_samples=3, hedge_min_delay=0.05),
+        )
+        # Sans historique de latence, aucune requête couverte
+        await scheduler.create("m", MESSAGES, max_tokens=10)
+        metrics = scheduler.queues["m"].metrics
+        hedges_without_samples = metrics.hedges
+        metrics.latencies.clear()
+        metrics.latencies.extend([0.05, 0.05, 0.05])
+        await scheduler.create("m", MESSAGES, max_tokens=10)
+        await asyncio.sleep(0.01)  # annulation de l'appel perdant
+        return hedges_without_samples, metrics, client
+
+    hedges_without_samples, metrics, client = asyncio.run(scenario())
+    assert hedges_without_samples == 0
+    assert (metrics.hedges, metrics.hedge_wins) == (1, 1)
+    assert len(client.calls) == 3
+    # L'appel perdant est annulé, et sa latence (au moins le délai de couverture) est conservée
+    assert client.cancelled == 1
+    assert len(metrics.latencies) == 5
+    assert max(metrics.latencies) >= 0.05
+
+
+def test_hedged_rate_limit_refunds_both_reservations():
+    async def scenario():
+        client = StubClient(errors=[RateLimited(), RateLimited()], delays=[0.3, 0.0])
+        scheduler = hedging_scheduler(client, requests_per_minute=6000, tokens_per_minute=600)
+        scheduler.config.max_rate_limit_retries = 0
+        with pytest.raises(RateLimited):
+            await scheduler.create("m", MESSAGES, max_tokens=100)
+        return scheduler.queues["m"]
+
+    queue = asyncio.run(scenario())
+    queue.tokens._refill()
+    assert queue.metrics.hedges == 1
+    assert queue.tokens.tokens == pytest.approx(600)
+
+
+def test_no_hedge_on_rate_limit_retry():
+    async def scenario():
+        client = StubClient(errors=[RateLimited(retry_after="0")], delays=[0.0, 0.3])
+        scheduler = hedging_scheduler(client)
+        response, _, _ = await scheduler.create("m", MESSAGES, max_tokens=10)
+        return response, client.calls, scheduler.queues["m"].metrics.hedges
+
+    assert asyncio.run(scenario()) == ("m", ["m", "m"], 0)
+
+
+def test_transient_errors_are_retried_on_the_same_reservation():
+    async def scenario():
+        client = StubClient(errors=[ServerError(), None])
+        scheduler = GroqScheduler(client, {"m": ModelLimits(600, 100000)},
+                                  config=SchedulerConfig(transient_backoff=0.01))
+        result = await scheduler.create("m", MESSAGES, max_tokens=10)
+        queue = scheduler.queues["m"]
+        with pytest.raises(ValueError):
+            scheduler.client.errors = [ValueError("requête invalide")]
+            await scheduler.create("m", MESSAGES, max_tokens=10)
+        return result, client.calls, queue.metrics.requests
+
+    (response, _, _), calls, requests_served = asyncio.run(scenario())
+    assert response == "m"
+    assert calls == ["m", "m", "m"]  # 503 relancé, erreur non transitoire remontée tout de suite
+    assert requests_served == 2
+
+
+def test_cancelling_request_cancels_groq_call():
+    async def scenario():
+        client = StubClient(delays=[5.0])
+        scheduler = GroqScheduler(client, {"m": ModelLimits(600, 100000)})
+        request = asyncio.ensure_future(scheduler.create("m", MESSAGES, max_tokens=10))
+        await asyncio.sleep(0.05)
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+        return client.cancelled
+
+    assert asyncio.run(scenario()) == 1
@@ -11,6 +11,8 @@ logger = logging.getLogger(__name__)
 
 # Configuration des clés API
 API_URL = os.getenv("API_URL", "http://localhost:8000")
+# Processus d'indexation (RAG_ROLE=writer) : thèmes et uploads, API_URL sert alors les requêtes
+WRITER_API_URL = os.getenv("WRITER_API_URL", API_URL)
 
 # Configuration des modèles d'embedding
 EMBEDDING_MODELS = {
@@ -47,7 +49,7 @@ def load_themes(refresh: bool = False):
     """Charge les thèmes avec option de forcage du rafraîchissement"""
     if refresh or "themes" not in st.session_state:
         try:
-            resp = requests.get(f"{API_URL}/themes", timeout=5)
+            resp = requests.get(f"{WRITER_API_URL}/themes", timeout=5)
             if resp.status_code == 200:
                 themes_data = resp.json().get("themes", [])
                 if isinstance(themes_data, dict):  # Cas API retourne un objet
@@ -87,7 +89,7 @@ with st.sidebar:
             if new_theme and new_theme not in st.session_state.themes:
                 try:
                     resp = requests.post(
-                        f"{API_URL}/theme",
+                        f"{WRITER_API_URL}/theme",
                         json={"name": new_theme, "embedding_model": EMBEDDING_MODELS[embedding_model]}
                     )
                     if resp.status_code == 200:
@@ -113,7 +115,7 @@ with st.sidebar:
         try:
             with st.spinner("Indexation en cours..."):
                 resp = requests.post(
-                    f"{API_URL}/theme/{current_theme}/upload",
+                    f"{WRITER_API_URL}/theme/{current_theme}/upload",
                     files=files,
                     timeout=30
                 )
@@ -209,6 +211,8 @@ if prompt := st.chat_input("Posez votre question..."):
 # ------------------ Informations supplémentaires ------------------
 with st.sidebar.expander("ℹ️ Informations"):
     st.write(f"**URL API:** {API_URL}")
+    if WRITER_API_URL != API_URL:
+        st.write(f"**URL indexation:** {WRITER_API_URL}")
     st.write(f"**Thème actif:** {current_theme}")
     
     if st.button("Actualiser les thèmes"):